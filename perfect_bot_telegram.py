@@ -1,29 +1,41 @@
 import os
-import json
+import re
+import orjson
 import time
+import hmac
+import hashlib
 import logging
+import signal
 import asyncio
+import functools
 import aiohttp
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from aiohttp import web
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
     filters,
     ContextTypes,
 )
 import redis
-from telegram.error import TelegramError
-from collections import deque
-from typing import Optional, Tuple
+import redis.asyncio as aioredis
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+from cachetools import TLRUCache, TTLCache
+from typing import Dict, Optional, Tuple
 
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[logging.StreamHandler(), logging.FileHandler('bot.log')]
 )
+# httpx внутри PTB пишет строку INFO на каждый запрос к Bot API
+logging.getLogger('httpx').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Конфигурация
@@ -32,65 +44,236 @@ CRYPTO_PAY_TOKEN = os.getenv('CRYPTO_PAY_TOKEN')
 REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
 CHANNEL_USERNAME = "@tpgbit"
 BOT_USERNAME = "BitCurrencyBot"
+# Вебхук Crypto Pay настраивается в @CryptoBot (Crypto Pay → My Apps → Webhooks).
+# Сервер вебхуков поднимается в процессе бота (worker в Procfile), а не в web.py: WEBHOOK_PORT
+# этого процесса должен быть доступен снаружи (проброс порта/прокси на него). На платформах, где
+# маршрутизируется только web-процесс, вебхуки до бота не дойдут — тогда оплаты подтверждает
+# только периодическая сверка счетов (INVOICE_RECONCILE_INTERVAL)
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+CRYPTO_PAY_WEBHOOK_PATH = os.getenv('CRYPTO_PAY_WEBHOOK_PATH', '/cryptopay')
+# Если задан публичный URL, Telegram присылает обновления на тот же сервер вместо long-polling
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')
 
 if not TELEGRAM_TOKEN or not CRYPTO_PAY_TOKEN:
     logger.critical("Missing TELEGRAM_TOKEN or CRYPTO_PAY_TOKEN")
     exit(1)
 
+# Путь и секрет вебхука по умолчанию выводятся из токена: не угадываются снаружи и совпадают у всех процессов,
+# так что set_webhook любого из них не ломает проверку у остальных
+TELEGRAM_WEBHOOK_PATH = os.getenv('TELEGRAM_WEBHOOK_PATH') or f"/telegram/{hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest()[:32]}"
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET') or hmac.new(TELEGRAM_TOKEN.encode(), b"telegram-webhook-secret", hashlib.sha256).hexdigest()
+
 AD_MESSAGE = "\n\n📢 Подпишись на @tpgbit для новостей о крипте\\!"
 FREE_REQUEST_LIMIT = 5
 SUBSCRIPTION_PRICE = 5
-CACHE_TIMEOUT = 300  # 5 минут для кэша курсов
-ADMIN_IDS = {"1058875848", "6403305626"}
+CACHE_TIMEOUT = 5  # кэш курсов не дольше окна снимка цен Binance, иначе котировки и алерты устаревают
+ADMIN_IDS = frozenset({"1058875848", "6403305626"})
 HISTORY_LIMIT = 20
 MAX_RETRIES = 3
-HIGH_PRECISION_CURRENCIES = {'BTC', 'ETH', 'XRP', 'DOGE', 'ADA', 'SOL', 'LTC', 'BNB', 'TRX', 'DOT', 'MATIC'}
+HIGH_PRECISION_CURRENCIES = frozenset({'BTC', 'ETH', 'XRP', 'DOGE', 'ADA', 'SOL', 'LTC', 'BNB', 'TRX', 'DOT', 'MATIC'})
 
 BINANCE_API_URL = "https://api.binance.com/api/v3/ticker/price"
+BINANCE_STREAM_URL = "wss://stream.binance.com:9443/ws/!miniTicker@arr"
 WHITEBIT_API_URL = "https://whitebit.com/api/v1/public/ticker"
 KUCOIN_API_URL = "https://api.kucoin.com/api/v1/market/allTickers"
+CRYPTO_PAY_API_URL = "https://pay.crypt.bot/api"
+CHANNEL_MEMBER_TTL = 300  # кэш подписки на канал, сек
+CHANNEL_NON_MEMBER_TTL = 30
+TELEGRAM_POOL_SIZE = 64  # keep-alive соединений к Bot API
+INVOICE_TTL = 3600  # время жизни счёта Crypto Pay, сек
+CRYPTO_PAY_INVOICES_BATCH = 1000  # максимум invoice_ids за один getInvoices
+INVOICE_RECONCILE_INTERVAL = 300  # сверка счетов на случай потерянного вебхука, сек
 
 CURRENCIES = {
-    'usd': {'code': 'USDT'}, 'uah': {'code': 'UAH'}, 'eur': {'code': 'EUR'},
-    'rub': {'code': 'RUB'}, 'jpy': {'code': 'JPY'}, 'cny': {'code': 'CNY'},
-    'gbp': {'code': 'GBP'}, 'kzt': {'code': 'KZT'}, 'try': {'code': 'TRY'},
-    'btc': {'code': 'BTC'}, 'eth': {'code': 'ETH'}, 'xrp': {'code': 'XRP'},
-    'doge': {'code': 'DOGE'}, 'ada': {'code': 'ADA'}, 'sol': {'code': 'SOL'},
-    'ltc': {'code': 'LTC'}, 'usdt': {'code': 'USDT'}, 'bnb': {'code': 'BNB'},
-    'trx': {'code': 'TRX'}, 'dot': {'code': 'DOT'}, 'matic': {'code': 'MATIC'}
+    'usd': 'USDT', 'uah': 'UAH', 'eur': 'EUR',
+    'rub': 'RUB', 'jpy': 'JPY', 'cny': 'CNY',
+    'gbp': 'GBP', 'kzt': 'KZT', 'try': 'TRY',
+    'btc': 'BTC', 'eth': 'ETH', 'xrp': 'XRP',
+    'doge': 'DOGE', 'ada': 'ADA', 'sol': 'SOL',
+    'ltc': 'LTC', 'usdt': 'USDT', 'bnb': 'BNB',
+    'trx': 'TRX', 'dot': 'DOT', 'matic': 'MATIC'
 }
+SUPPORTED_CURRENCIES = frozenset(CURRENCIES)
+# Знаков после запятой в результате: криптовалютам 8, остальным 2
+CURRENCY_PRECISION = {key: 8 if code in HIGH_PRECISION_CURRENCIES else 2 for key, code in CURRENCIES.items()}
+# Символы Binance из пар поддерживаемых валют, только они попадают в снимок цен
+BINANCE_SYMBOLS = frozenset(f"{a}{b}" for a in CURRENCIES.values() for b in CURRENCIES.values() if a != b)
+BINANCE_SNAPSHOT_INTERVAL = 5
+CURRENCIES_TEXT = f"💱 *Поддерживаемые валюты*:\n{', '.join(sorted(CURRENCIES))}"
+CONVERSION_RE = re.compile(r'^\s*(?:(\d+(?:\.\d+)?)\s+)?([a-z]{2,5})\s+([a-z]{2,5})\s*$')
+ALERT_RE = re.compile(r'^([a-z]{2,5}) ([a-z]{2,5}) (\d+(?:\.\d+)?)$')
+
+# Статичные тексты и клавиатуры собираются один раз при загрузке
+START_TEXT = (
+    f"👋 *Привет*\\! Я {BOT_USERNAME} — твой помощник для конвертации валют\\!\n"
+    f"🔑 *Бесплатно*: {FREE_REQUEST_LIMIT} запросов в сутки\n"
+    f"🌟 *Безлимит*: /subscribe за {SUBSCRIPTION_PRICE} USDT{AD_MESSAGE}"
+)
+START_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💱 Конвертер", callback_data="converter"), InlineKeyboardButton("📈 Курсы", callback_data="price")],
+    [InlineKeyboardButton("📊 Статистика", callback_data="stats"), InlineKeyboardButton("💎 Подписка", callback_data="subscribe")],
+    [InlineKeyboardButton("🔔 Уведомления", callback_data="alert"), InlineKeyboardButton("👥 Рефералы", callback_data="referrals")],
+    [InlineKeyboardButton("📜 История", callback_data="history")]
+])
+THROTTLE_DELAY = 5  # секунд между запросами без подписки
+THROTTLE_TEXT = f"⏳ Подожди {THROTTLE_DELAY} секунд{'у' if THROTTLE_DELAY == 1 else ''}\\!"
+LIMIT_TEXT = f"❌ Лимит {FREE_REQUEST_LIMIT} запросов исчерпан\\. /subscribe"
+SUBSCRIBE_TEXT = f"💎 Оплати *{SUBSCRIPTION_PRICE} USDT* для безлимита:"
+ALERT_HELP_TEXT = "🔔 *Настрой уведомления*\\! Формат: `/alert <валюта1> <валюта2> <курс>`\nПримеры ниже:"
+ALERT_EXAMPLE_USD_BTC_TEXT = "🔔 Пример: `/alert usd btc 0\\.000015` — уведомит, когда 1 USD \\= 0\\.000015 BTC"
+ALERT_EXAMPLE_EUR_UAH_TEXT = "🔔 Пример: `/alert eur uah 45\\.0` — уведомит, когда 1 EUR \\= 45\\.0 UAH"
+CONVERTER_TEXT = "💱 *Выбери пару или введи вручную \\(например, '100\\.0 uah usdt'\\)*:"
+MANUAL_CONVERT_TEXT = "💱 *Введи запрос вручную*: например, '100\\.0 uah usdt'"
+PRICE_TEXT = "📈 *Выбери валюту для курса*:"
+BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="start")]])
+RETRY_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("💱 Попробовать снова", callback_data="converter")]])
+ALERT_HELP_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔔 USD → BTC", callback_data="alert_example_usd_btc")],
+    [InlineKeyboardButton("🔔 EUR → UAH", callback_data="alert_example_eur_uah")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="start")]
+])
+ALERT_ADDED_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔔 Добавить ещё", callback_data="alert"), InlineKeyboardButton("🔙 Назад", callback_data="start")]
+])
+REFERRALS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔗 Копировать", callback_data="copy_ref"), InlineKeyboardButton("🔙 Назад", callback_data="start")]
+])
+CONVERTER_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💰 USD → BTC", callback_data="convert:usd:btc"), InlineKeyboardButton("💶 EUR → UAH", callback_data="convert:eur:uah")],
+    [InlineKeyboardButton("₿ BTC → ETH", callback_data="convert:btc:eth"), InlineKeyboardButton("₴ UAH → USDT", callback_data="convert:uah:usdt")],
+    [InlineKeyboardButton("🔄 Ввести вручную", callback_data="manual_convert"), InlineKeyboardButton("🔙 Назад", callback_data="start")]
+])
+PRICE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("BTC", callback_data="convert:btc:usdt"), InlineKeyboardButton("ETH", callback_data="convert:eth:usdt")],
+    [InlineKeyboardButton("USD", callback_data="convert:usd:uah"), InlineKeyboardButton("EUR", callback_data="convert:eur:uah")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="start")]
+])
+CONVERSION_TAIL_ROW = (InlineKeyboardButton("💱 Другая пара", callback_data="converter"), InlineKeyboardButton("🔙 Назад", callback_data="start"))
+
+@functools.lru_cache(maxsize=None)
+def conversion_markup(from_currency: str, to_currency: str) -> InlineKeyboardMarkup:
+    # Пар валют конечное число, клавиатура под результатом собирается один раз на пару
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Ещё раз", callback_data=f"convert:{from_currency}:{to_currency}")],
+        CONVERSION_TAIL_ROW
+    ])
+
+http_session: Optional[aiohttp.ClientSession] = None
+subscription_cache: TTLCache = TTLCache(maxsize=10000, ttl=2)
+inflight_rates: Dict[Tuple[str, str], asyncio.Task] = {}
+# Ограничение одновременных запросов к биржам, чтобы пачка алертов не упиралась в их лимиты
+EXCHANGE_CONCURRENCY = 10
+exchange_requests = asyncio.Semaphore(EXCHANGE_CONCURRENCY)
+# Исходящие уведомления: не больше TELEGRAM_SEND_CONCURRENCY одновременно, после 429 все ждут общий срок
+TELEGRAM_SEND_CONCURRENCY = 25
+telegram_sends = asyncio.Semaphore(TELEGRAM_SEND_CONCURRENCY)
+telegram_sends_paused_until = 0.0
+# Исход отправки уведомления: доставлено, отклонено навсегда (бот заблокирован, чат не найден), временный сбой
+NOTIFY_SENT, NOTIFY_REJECTED, NOTIFY_FAILED = 1, 0, -1
+# Локальный кэш курсов перед Redis: (курс, описание источника, момент истечения по time.monotonic) по паре валют.
+# Срок у каждой записи свой: взятая из Redis запись живёт ровно столько, сколько осталось ключу
+rate_cache: TLRUCache = TLRUCache(maxsize=4096, ttu=lambda key, value, now: value[2])
+# Последний снимок KuCoin allTickers: символ -> цена
+kucoin_tickers: TTLCache = TTLCache(maxsize=1, ttl=BINANCE_SNAPSHOT_INTERVAL)
+# Цены Binance из WebSocket-потока (или последнего REST-снимка) и время их обновления
+binance_prices: Dict[str, float] = {}
+binance_prices_updated = float("-inf")
+# Символы, которые Binance реально торгует (по полному тикеру при старте и при REST-обновлении); пусто — ещё не знаем
+binance_listed: frozenset = frozenset()
+BINANCE_PRICES_MAX_AGE = BINANCE_SNAPSHOT_INTERVAL * 2
 
 UAH_TO_USDT_FALLBACK = 0.0239  # 1 UAH = 0.0239 USDT
-USDT_TO_UAH_FALLBACK = 41.84   # 1 USDT = 41.84 UAH
 EUR_TO_USDT_FALLBACK = 1.08    # 1 EUR = 1.08 USDT
+# Фиксированные курсы к USDT для валют, у которых может не быть живого курса
+FALLBACK_USDT_RATES = {'UAH': UAH_TO_USDT_FALLBACK, 'EUR': EUR_TO_USDT_FALLBACK}
 
-redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True, ssl_cert_reqs="none", socket_timeout=10)
+redis_pool = aioredis.BlockingConnectionPool.from_url(
+    REDIS_URL, max_connections=64, timeout=2, decode_responses=True, ssl_cert_reqs="none", socket_timeout=10
+)
+redis_client = aioredis.Redis(connection_pool=redis_pool)
 
-def init_redis_connection() -> bool:
+async def init_redis_connection() -> bool:
     for attempt in range(MAX_RETRIES):
         try:
-            redis_client.ping()
+            await redis_client.ping()
             logger.info("Successfully connected to Redis")
             return True
         except redis.ConnectionError as e:
             logger.warning(f"Redis connection attempt {attempt + 1}/{MAX_RETRIES} failed: {e}")
-            time.sleep(2 ** attempt)
+            await asyncio.sleep(2 ** attempt)
     logger.critical("Failed to connect to Redis after retries")
     return False
 
-if not init_redis_connection():
-    exit(1)
-
 def escape_markdown_v2(text: str) -> str:
     reserved_chars = r'_*[]()~`>#+-=|{}!.'
     for char in reserved_chars:
         text = text.replace(char, f'\\{char}')
     return text
 
+def parse_conversion(text: str) -> Tuple[float, str, str]:
+    match = CONVERSION_RE.match(text.lower())
+    if not match:
+        raise ValueError("Неверный формат")
+    amount, from_currency, to_currency = match.groups()
+    if from_currency not in SUPPORTED_CURRENCIES or to_currency not in SUPPORTED_CURRENCIES:
+        raise ValueError("Неподдерживаемая валюта")
+    return float(amount) if amount else 1.0, from_currency, to_currency
+
+async def respond(update: Update, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+    # Нажатие кнопки правит её сообщение, команда получает новое; ошибки отправки только логируются
+    for attempt in range(2):
+        try:
+            if update.callback_query:
+                await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
+            else:
+                await update.effective_message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
+            return
+        except RetryAfter as e:
+            if attempt:
+                logger.error(f"Failed to respond to {update.effective_user.id}: {e}")
+                return
+            await asyncio.sleep(e.retry_after)
+        except TelegramError as e:
+            logger.error(f"Failed to respond to {update.effective_user.id}: {e}")
+            return
+
+async def send_notification(bot: Bot, chat_id: str, text: str) -> int:
+    global telegram_sends_paused_until
+    for attempt in range(2):
+        # Пауза после 429 выдерживается вне семафора, чтобы ожидание не занимало слоты отправки
+        pause = telegram_sends_paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        async with telegram_sends:
+            try:
+                await bot.send_message(chat_id, text, parse_mode=ParseMode.MARKDOWN_V2)
+                return NOTIFY_SENT
+            except RetryAfter as e:
+                # Лимит Telegram общий для бота: пауза распространяется на все следующие отправки
+                telegram_sends_paused_until = max(telegram_sends_paused_until, time.monotonic() + e.retry_after)
+                if attempt:
+                    logger.error(f"Failed to send notification to {chat_id}: {e}")
+            except (Forbidden, BadRequest) as e:
+                logger.warning(f"Notification to {chat_id} rejected: {e}")
+                return NOTIFY_REJECTED
+            except TelegramError as e:
+                logger.error(f"Failed to send notification to {chat_id}: {e}")
+                return NOTIFY_FAILED
+    return NOTIFY_FAILED
+
 async def check_subscription(context: ContextTypes.DEFAULT_TYPE, user_id: str) -> bool:
+    if user_id in ADMIN_IDS:
+        return True
+    # Статус подписки на канал кэшируется; отказ хранится недолго, чтобы только что подписавшийся не ждал
+    cached = await redis_client.get(f"channel_member:{user_id}")
+    if cached is not None:
+        return cached == '1'
     try:
         chat_member = await context.bot.get_chat_member(CHANNEL_USERNAME, user_id)
-        return chat_member.status in ['member', 'administrator', 'creator']
+        subscribed = chat_member.status in ['member', 'administrator', 'creator']
+        await redis_client.setex(f"channel_member:{user_id}", CHANNEL_MEMBER_TTL if subscribed else CHANNEL_NON_MEMBER_TTL, '1' if subscribed else '0')
+        return subscribed
     except TelegramError as e:
         logger.error(f"Failed to check subscription for user {user_id}: {e}")
         return False
@@ -99,412 +282,517 @@ async def enforce_subscription(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id = str(update.effective_user.id)
     if await check_subscription(context, user_id):
         return True
-    message = "🚫 Подпишись на @tpgbit, чтобы продолжить\\!"
-    try:
-        if update.callback_query:
+    if update.callback_query:
+        try:
             await update.callback_query.answer()
-            await update.callback_query.edit_message_text(message, parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await update.effective_message.reply_text(message, parse_mode=ParseMode.MARKDOWN_V2)
-    except TelegramError as e:
-        logger.error(f"Failed to send subscription message to {user_id}: {e}")
+        except TelegramError as e:
+            logger.error(f"Failed to answer callback query for {user_id}: {e}")
+    await respond(update, "🚫 Подпишись на @tpgbit, чтобы продолжить\\!")
     return False
 
-def save_stats(user_id: str, request_type: str):
+async def subscription_gate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Проверка подписки на канал один раз на апдейт, до всех обработчиков
+    if update.effective_user is None or (update.effective_message is None and update.callback_query is None):
+        return
+    if not await enforce_subscription(update, context):
+        raise ApplicationHandlerStop
+
+# Счётчик запросов за день живёт в отдельном ключе и истекает сам, сброс не нужен
+DAILY_REQUESTS_TTL = 90000
+today_str = ""
+today_ends = 0.0
+
+def today() -> str:
+    # Строка даты пересчитывается только после локальной полуночи
+    global today_str, today_ends
+    now = time.time()
+    if now >= today_ends:
+        local = time.localtime(now)
+        today_str = time.strftime("%Y-%m-%d", local)
+        today_ends = time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+    return today_str
+
+def daily_requests_key(user_id: str) -> str:
+    return f"stats:requests:{user_id}:{today()}"
+
+# KEYS: stats:requests:<uid>:<день>, stats:users, stats:total, stats:types; ARGV: TTL счётчика, тип запроса, uid
+SAVE_STATS_LUA = """
+if redis.call('INCR', KEYS[1]) == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+redis.call('SADD', KEYS[2], ARGV[3])
+redis.call('INCR', KEYS[3])
+redis.call('HINCRBY', KEYS[4], ARGV[2], 1)
+return 1
+"""
+save_stats_script = redis_client.register_script(SAVE_STATS_LUA)
+
+async def save_stats(user_id: str, request_type: str):
     try:
-        stats = json.loads(redis_client.get('stats') or '{}')
-        current_day = time.strftime("%Y-%m-%d")
-        users = stats.setdefault("users", {})
-        user_data = users.setdefault(user_id, {"requests": 0, "last_reset": current_day})
-        if user_data["last_reset"] != current_day:
-            user_data.update(requests=0, last_reset=current_day)
-        user_data["requests"] += 1
-        stats["total_requests"] = stats.get("total_requests", 0) + 1
-        stats.setdefault("request_types", {}).setdefault(request_type, 0)
-        stats["request_types"][request_type] += 1
-        redis_client.setex('stats', 24 * 60 * 60, json.dumps(stats))
+        await save_stats_script(
+            keys=[daily_requests_key(user_id), 'stats:users', 'stats:total', 'stats:types'],
+            args=[DAILY_REQUESTS_TTL, request_type, user_id]
+        )
     except Exception as e:
         logger.error(f"Error saving stats for user {user_id}: {e}")
 
-def save_history(user_id: str, from_currency: str, to_currency: str, amount: float, result: float):
+async def is_throttled(user_id: str, delay: int) -> bool:
+    if not delay:
+        return False
+    try:
+        # Первый запрос в окне создаёт ключ с TTL; пока ключ жив, SET NX возвращает None
+        return await redis_client.set(f"throttle:{user_id}", 1, ex=delay, nx=True) is None
+    except redis.RedisError as e:
+        logger.error(f"Error checking throttle for user {user_id}: {e}")
+        return False
+
+async def save_history(user_id: str, from_currency: str, to_currency: str, amount: float, result: float):
     try:
-        history = deque(json.loads(redis_client.get(f"history:{user_id}") or '[]'), maxlen=HISTORY_LIMIT)
-        history.append({
-            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        entry = orjson.dumps({
+            # Время хранится unix-меткой и форматируется только при показе истории
+            "time": int(time.time()),
             "from": from_currency,
             "to": to_currency,
             "amount": amount,
             "result": result
         })
-        redis_client.setex(f"history:{user_id}", 30 * 24 * 60 * 60, json.dumps(list(history)))
+        # Список в Redis: новые записи в начале, хвост обрезается до HISTORY_LIMIT
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.lpush(f"history:{user_id}", entry)
+        pipe.ltrim(f"history:{user_id}", 0, HISTORY_LIMIT - 1)
+        pipe.expire(f"history:{user_id}", 30 * 24 * 60 * 60)
+        await pipe.execute()
     except Exception as e:
         logger.error(f"Error saving history for user {user_id}: {e}")
 
-def check_limit(user_id: str) -> Tuple[bool, str]:
+async def get_user_requests(user_id: str) -> int:
+    return int(await redis_client.get(daily_requests_key(user_id)) or 0)
+
+async def has_paid_subscription(user_id: str) -> bool:
+    subscribed = subscription_cache.get(user_id)
+    if subscribed is None:
+        subscribed = bool(await redis_client.sismember('stats:subs', user_id))
+        subscription_cache[user_id] = subscribed
+    return subscribed
+
+async def get_user_state(user_id: str) -> Tuple[bool, int]:
+    # Подписка берётся из локального кэша, если есть; тогда в Redis остаётся только счётчик запросов
+    subscribed = subscription_cache.get(user_id)
+    if subscribed is not None:
+        return subscribed, await get_user_requests(user_id)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.sismember('stats:subs', user_id)
+    pipe.get(daily_requests_key(user_id))
+    subscribed, requests = await pipe.execute()
+    subscription_cache[user_id] = bool(subscribed)
+    return bool(subscribed), int(requests or 0)
+
+async def check_limit(user_id: str) -> Tuple[bool, str]:
     try:
         if user_id in ADMIN_IDS:
             return True, "∞"
-        stats = json.loads(redis_client.get('stats') or '{}')
-        if stats.get("subscriptions", {}).get(user_id):
+        subscribed, requests_today = await get_user_state(user_id)
+        if subscribed:
             return True, "∞"
-        users = stats.get("users", {})
-        user_data = users.get(user_id, {"requests": 0, "last_reset": time.strftime("%Y-%m-%d")})
-        remaining = FREE_REQUEST_LIMIT - user_data["requests"]
+        remaining = FREE_REQUEST_LIMIT - requests_today
         return remaining > 0, str(remaining)
     except Exception as e:
         logger.error(f"Error checking limit for user {user_id}: {e}")
         return False, "0"
 
+# Проверка подписки, паузы и лимита вместе с учётом запроса за один вызов.
+# KEYS: stats:subs, throttle:<uid>, stats:requests:<uid>:<день>, stats:users, stats:total, stats:types
+# ARGV: uid, админ (1/0), пауза, дневной лимит, TTL счётчика, тип запроса; ответ: {исход, остаток (-1 — безлимит)}
+# Исход: 1 — запрос пропущен и учтён, 0 — исчерпан дневной лимит, -1 — слишком частые запросы
+REQUEST_ALLOWED, REQUEST_LIMITED, REQUEST_THROTTLED = 1, 0, -1
+COUNT_REQUEST_LUA = """
+local unlimited = ARGV[2] == '1' or redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1
+local remaining = -1
+if not unlimited then
+    if not redis.call('SET', KEYS[2], 1, 'EX', ARGV[3], 'NX') then
+        return {-1, 0}
+    end
+    remaining = tonumber(ARGV[4]) - tonumber(redis.call('GET', KEYS[3]) or '0')
+    if remaining <= 0 then
+        return {0, 0}
+    end
+end
+if redis.call('INCR', KEYS[3]) == 1 then
+    redis.call('EXPIRE', KEYS[3], ARGV[5])
+end
+redis.call('SADD', KEYS[4], ARGV[1])
+redis.call('INCR', KEYS[5])
+redis.call('HINCRBY', KEYS[6], ARGV[6], 1)
+return {1, remaining}
+"""
+count_request_script = redis_client.register_script(COUNT_REQUEST_LUA)
+
+async def count_request(user_id: str, request_type: str) -> Tuple[int, str]:
+    try:
+        outcome, remaining = await count_request_script(
+            keys=['stats:subs', f"throttle:{user_id}", daily_requests_key(user_id), 'stats:users', 'stats:total', 'stats:types'],
+            args=[user_id, int(user_id in ADMIN_IDS), THROTTLE_DELAY, FREE_REQUEST_LIMIT, DAILY_REQUESTS_TTL, request_type]
+        )
+        return outcome, "∞" if remaining < 0 else str(remaining)
+    except Exception as e:
+        logger.error(f"Error counting request for user {user_id}: {e}")
+        return REQUEST_LIMITED, "0"
+
 async def fetch_rate(session: aiohttp.ClientSession, url: str, key: str, reverse: bool = False, api_name: str = "API") -> Optional[float]:
     try:
-        async with session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as response:
-            data = await response.json()
-            logger.debug(f"API response from {api_name}: {data}")
+        async with exchange_requests, session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+            data = await response.json(loads=orjson.loads)
+            logger.debug("API response from %s: %s", api_name, data)
             rate = float(data.get(key if not reverse else 'price', 0))
             if rate <= 0:
                 logger.warning(f"{api_name} returned invalid rate: {rate}")
                 return None
-            logger.info(f"{api_name} rate: {rate}")
+            logger.info("%s rate: %s", api_name, rate)
             return 1 / rate if reverse else rate
-    except (aiohttp.ClientError, ValueError, KeyError, TypeError) as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as e:
         logger.warning(f"Error fetching rate from {api_name}: {str(e)}")
         return None
 
+async def fetch_binance_rate(session: aiohttp.ClientSession, from_code: str, to_code: str) -> Optional[float]:
+    symbol = f"{from_code}{to_code}"
+    if binance_listed and symbol not in binance_listed:
+        # Пары нет на Binance: не тратим запрос, который вернёт 400
+        return None
+    return await fetch_rate(session, f"{BINANCE_API_URL}?symbol={symbol}", 'price', False, f"Binance {symbol}")
+
 async def fetch_kucoin_rate(session: aiohttp.ClientSession, from_code: str, to_code: str) -> Optional[float]:
+    ticker = f"{from_code}-{to_code}"
     try:
-        async with session.get(KUCOIN_API_URL, timeout=aiohttp.ClientTimeout(total=5)) as response:
-            data = await response.json()
-            logger.debug(f"KuCoin API response: {data}")
-            ticker = f"{from_code}-{to_code}"
-            for item in data['data']['ticker']:
-                if item['symbol'] == ticker:
-                    rate = float(item['last'])
-                    if rate > 0:
-                        logger.info(f"KuCoin rate for {ticker}: {rate}")
-                        return rate
-            return None
-    except (aiohttp.ClientError, ValueError, KeyError, TypeError) as e:
+        # allTickers отдаёт все пары сразу: один запрос на окно снимка, дальше поиск по словарю
+        tickers = kucoin_tickers.get('all')
+        if tickers is None:
+            async with exchange_requests, session.get(KUCOIN_API_URL, timeout=aiohttp.ClientTimeout(total=5)) as response:
+                data = await response.json(loads=orjson.loads)
+            tickers = {item['symbol']: item['last'] for item in data['data']['ticker'] if item.get('last')}
+            kucoin_tickers['all'] = tickers
+            logger.debug("KuCoin tickers refreshed: %d symbols", len(tickers))
+        rate = float(tickers.get(ticker) or 0)
+        if rate > 0:
+            logger.info("KuCoin rate for %s: %s", ticker, rate)
+            return rate
+        return None
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as e:
         logger.warning(f"Error fetching rate from KuCoin: {e}")
         return None
 
+def store_binance_prices(prices: Dict[str, str]):
+    global binance_prices_updated
+    if not prices:
+        return
+    for symbol, price in prices.items():
+        binance_prices[symbol] = float(price)
+    binance_prices_updated = time.monotonic()
+
+async def binance_price_stream():
+    # Binance раз в секунду присылает изменившиеся цены всех символов; при обрыве переподключаемся
+    while True:
+        try:
+            async with http_session.ws_connect(BINANCE_STREAM_URL, heartbeat=30) as ws:
+                logger.info("Connected to Binance price stream")
+                async for message in ws:
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    store_binance_prices({item['s']: item['c'] for item in orjson.loads(message.data) if item['s'] in BINANCE_SYMBOLS})
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Binance price stream error: {e}")
+        await asyncio.sleep(BINANCE_SNAPSHOT_INTERVAL)
+
+async def load_binance_prices():
+    global binance_listed
+    # Полный тикер без параметров: заодно узнаём, какие из наших пар Binance вообще торгует
+    async with http_session.get(BINANCE_API_URL, timeout=aiohttp.ClientTimeout(total=5)) as response:
+        data = await response.json(loads=orjson.loads)
+    prices = {item['symbol']: item['price'] for item in data if item['symbol'] in BINANCE_SYMBOLS}
+    binance_listed = frozenset(prices)
+    store_binance_prices(prices)
+
+async def refresh_binance_prices(context: ContextTypes.DEFAULT_TYPE):
+    # Поток цен жив — только публикуем его в Redis для других процессов, иначе один REST-запрос за всеми ценами
+    try:
+        if time.monotonic() - binance_prices_updated > BINANCE_PRICES_MAX_AGE:
+            await load_binance_prices()
+        prices = dict(binance_prices)
+        if not prices:
+            logger.warning("Binance price snapshot is empty")
+            return
+        pipe = redis_client.pipeline()
+        pipe.delete('binance:prices')
+        pipe.hset('binance:prices', mapping=prices)
+        pipe.expire('binance:prices', BINANCE_SNAPSHOT_INTERVAL * 2)
+        await pipe.execute()
+        logger.debug("Binance price snapshot refreshed: %d symbols", len(prices))
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError, redis.RedisError) as e:
+        logger.warning(f"Error refreshing Binance price snapshot: {e}")
+
+async def get_binance_snapshot(symbols: Tuple[str, ...]) -> Dict[str, float]:
+    if time.monotonic() - binance_prices_updated < BINANCE_PRICES_MAX_AGE:
+        return {symbol: binance_prices[symbol] for symbol in symbols if binance_prices.get(symbol, 0) > 0}
+    try:
+        prices = await redis_client.hmget('binance:prices', symbols)
+    except redis.RedisError as e:
+        logger.error(f"Error reading Binance price snapshot: {e}")
+        return {}
+    snapshot = {}
+    for symbol, price in zip(symbols, prices):
+        if price and float(price) > 0:
+            snapshot[symbol] = float(price)
+    return snapshot
+
 async def get_exchange_rate(from_currency: str, to_currency: str, amount: float = 1.0) -> Tuple[Optional[float], str]:
     from_key, to_key = from_currency.lower(), to_currency.lower()
-    if from_key not in CURRENCIES or to_key not in CURRENCIES:
+    if from_key not in SUPPORTED_CURRENCIES or to_key not in SUPPORTED_CURRENCIES:
         logger.error(f"Unsupported currency pair: {from_key} to {to_key}")
         return None, "Неподдерживаемая валюта или неверный формат\\. Пример: `100\\.0 uah usdt`"
 
-    from_code, to_code = CURRENCIES[from_key]['code'], CURRENCIES[to_key]['code']
     if from_key == to_key:
         return amount, f"1 {from_key.upper()} \\= 1 {to_key.upper()}"
 
-    async with aiohttp.ClientSession() as session:
-        # Прямые запросы для популярных пар
-        direct_pairs = {'BTCUSDT', 'ETHUSDT', 'EURUSDT', 'USDTUAH'}
-        tasks = []
-        if f"{from_code}{to_code}" in direct_pairs:
-            tasks.append(fetch_rate(session, f"{BINANCE_API_URL}?symbol={from_code}{to_code}", 'price', False, f"Binance {from_code}{to_code}"))
-        tasks.append(fetch_kucoin_rate(session, from_code, to_code))
-
-        # Мост через USDT
-        usdt_tasks = [
-            fetch_rate(session, f"{BINANCE_API_URL}?symbol={from_code}USDT", 'price', False, f"Binance {from_code}USDT") if from_code != 'USDT' else None,
-            fetch_rate(session, f"{BINANCE_API_URL}?symbol={to_code}USDT", 'price', False, f"Binance {to_code}USDT") if to_code != 'USDT' else None
-        ]
-
-        # Выполняем все запросы параллельно
-        results = await asyncio.gather(*(tasks + usdt_tasks), return_exceptions=True)
-        sources = [f"Binance {from_code}{to_code}", "KuCoin", f"Binance {from_code}USDT", f"Binance {to_code}USDT"]
-
-        # Прямой курс
-        for i, (rate, source) in enumerate(zip(results[:len(tasks)], sources[:len(tasks)])):
+    cached = await get_cached_rate(from_key, to_key)
+    if cached:
+        rate, rate_info = cached
+        return amount * rate, rate_info
+
+    # Одновременные запросы одной пары ждут один общий запрос к биржам
+    pair = (from_key, to_key)
+    task = inflight_rates.get(pair)
+    if task is None:
+        task = asyncio.create_task(fetch_exchange_rate(from_key, to_key))
+        inflight_rates[pair] = task
+        task.add_done_callback(lambda _: inflight_rates.pop(pair, None))
+    rate, rate_info = await asyncio.shield(task)
+    return (amount * rate if rate is not None else None), rate_info
+
+async def get_cached_rate(from_key: str, to_key: str) -> Optional[Tuple[float, str]]:
+    # Сначала локальный кэш процесса, затем Redis
+    cached = rate_cache.get((from_key, to_key))
+    if cached:
+        return cached[0], cached[1]
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(f"rate:{from_key}_{to_key}")
+        pipe.pttl(f"rate:{from_key}_{to_key}")
+        data, ttl_ms = await pipe.execute()
+        if not data:
+            return None
+        rate, rate_info = orjson.loads(data)
+    except (redis.RedisError, orjson.JSONDecodeError, TypeError, ValueError) as e:
+        logger.error(f"Error reading cached rate {from_key}_{to_key}: {e}")
+        return None
+    if ttl_ms > 0:
+        rate_cache[(from_key, to_key)] = (rate, rate_info, time.monotonic() + ttl_ms / 1000)
+    return rate, rate_info
+
+async def cache_rate(from_key: str, to_key: str, rate: float, rate_info: str):
+    rate_cache[(from_key, to_key)] = (rate, rate_info, time.monotonic() + CACHE_TIMEOUT)
+    try:
+        await redis_client.setex(f"rate:{from_key}_{to_key}", CACHE_TIMEOUT, orjson.dumps([rate, rate_info]))
+    except redis.RedisError as e:
+        logger.error(f"Error caching rate {from_key}_{to_key}: {e}")
+
+# Источники прямого курса пары; pairs ограничивает символы, которые есть у биржи (None — любые).
+# Пары вида XUSDT у Binance не нужны: они и так запрашиваются как плечо моста через USDT
+RATE_SOURCES = [
+    {"name": "Binance", "fetch": fetch_binance_rate, "pairs": {'USDTUAH'}},
+    {"name": "KuCoin", "fetch": fetch_kucoin_rate, "pairs": None},
+]
+
+@functools.lru_cache(maxsize=None)
+def rate_plan(from_key: str, to_key: str) -> Tuple[str, str, str, Tuple[str, ...], Tuple[dict, ...]]:
+    # План запроса зависит только от пары: коды, символы Binance и подходящие источники считаются один раз
+    from_code, to_code = CURRENCIES[from_key], CURRENCIES[to_key]
+    direct_symbol = f"{from_code}{to_code}"
+    usdt_symbols = tuple(f"{code}USDT" for code in (from_code, to_code) if code != 'USDT')
+    sources = tuple(source for source in RATE_SOURCES if source["pairs"] is None or direct_symbol in source["pairs"])
+    return from_code, to_code, direct_symbol, usdt_symbols, sources
+
+async def rate_result(from_key: str, to_key: str, rate: float, source: str) -> Tuple[float, str]:
+    from_code, to_code = CURRENCIES[from_key], CURRENCIES[to_key]
+    rate_info = f"1 {from_code} \\= {escape_markdown_v2(str(rate))} {to_code} \\({escape_markdown_v2(source)}\\)"
+    await cache_rate(from_key, to_key, rate, rate_info)
+    return rate, rate_info
+
+async def fetch_exchange_rate(from_key: str, to_key: str) -> Tuple[Optional[float], str]:
+    from_code, to_code, direct_symbol, usdt_symbols, sources = rate_plan(from_key, to_key)
+    # usd и usdt — один и тот же USDT: курс 1 без бирж и без несуществующего символа USDTUSDT
+    if from_code == to_code:
+        return await rate_result(from_key, to_key, 1.0, "та же валюта")
+
+    # Сначала снимок цен Binance из Redis, без запросов к бирже
+    snapshot = await get_binance_snapshot((direct_symbol,) + usdt_symbols)
+    if direct_symbol in snapshot:
+        logger.info("Using snapshot rate for %s to %s: %s", from_code, to_code, snapshot[direct_symbol])
+        return await rate_result(from_key, to_key, snapshot[direct_symbol], f"Binance {direct_symbol}")
+    # Мост через USDT (для самого USDT курс равен 1)
+    usdt_rates = {'USDT': 1.0}
+    usdt_rates.update((symbol[:-len('USDT')], snapshot[symbol]) for symbol in usdt_symbols if symbol in snapshot)
+
+    if from_code not in usdt_rates or to_code not in usdt_rates:
+        # Все источники прямого курса и недостающие плечи моста опрашиваются параллельно
+        missing = [symbol for symbol in usdt_symbols if symbol not in snapshot]
+        results = await asyncio.gather(
+            *(source["fetch"](http_session, from_code, to_code) for source in sources),
+            *(fetch_binance_rate(http_session, symbol[:-len('USDT')], 'USDT') for symbol in missing),
+            return_exceptions=True
+        )
+        for symbol, rate in zip(missing, results[len(sources):]):
             if isinstance(rate, float) and rate > 0:
-                logger.info(f"Using direct rate for {from_code} to {to_code}: {rate} from {source}")
-                redis_client.setex(f"rate:{from_key}_{to_key}", CACHE_TIMEOUT, str(rate))
-                return amount * rate, f"1 {from_code} \\= {escape_markdown_v2(str(rate))} {to_code} \\({escape_markdown_v2(source)}\\)"
-
-        # Мост через USDT
-        rate_from_usdt = results[len(tasks)] if isinstance(results[len(tasks)], float) and results[len(tasks)] > 0 else None
-        rate_to_usdt = results[len(tasks) + 1] if isinstance(results[len(tasks) + 1], float) and results[len(tasks) + 1] > 0 else None
-        
-        if from_key == 'usdt' and rate_to_usdt:
-            rate = 1 / rate_to_usdt
-            logger.info(f"Rate via USDT for {from_code} to {to_code}: {rate}")
-            redis_client.setex(f"rate:{from_key}_{to_key}", CACHE_TIMEOUT, str(rate))
-            return amount * rate, f"1 {from_code} \\= {escape_markdown_v2(str(rate))} {to_code} \\(Binance via USDT\\)"
-        elif to_key == 'usdt' and rate_from_usdt:
-            rate = rate_from_usdt
-            logger.info(f"Rate via USDT for {from_code} to {to_code}: {rate}")
-            redis_client.setex(f"rate:{from_key}_{to_key}", CACHE_TIMEOUT, str(rate))
-            return amount * rate, f"1 {from_code} \\= {escape_markdown_v2(str(rate))} {to_code} \\(Binance via USDT\\)"
-        elif rate_from_usdt and rate_to_usdt:
-            rate = rate_from_usdt / rate_to_usdt
-            logger.info(f"Rate via USDT for {from_code} to {to_code}: {rate} ({rate_from_usdt}/{rate_to_usdt})")
-            redis_client.setex(f"rate:{from_key}_{to_key}", CACHE_TIMEOUT, str(rate))
-            return amount * rate, f"1 {from_code} \\= {escape_markdown_v2(str(rate))} {to_code} \\(Binance via USDT\\)"
-
-        # Fallback для BTC, ETH и других валют
-        if from_key == 'btc' and to_key in ['usdt', 'eur', 'uah']:
-            rate_btc_usdt = await fetch_rate(session, f"{BINANCE_API_URL}?symbol=BTCUSDT", 'price', False, "Binance BTCUSDT")
-            if rate_btc_usdt:
-                if to_key == 'usdt':
-                    rate = rate_btc_usdt
-                elif to_key == 'eur':
-                    rate_eur_usdt = await fetch_rate(session, f"{BINANCE_API_URL}?symbol=EURUSDT", 'price', False, "Binance EURUSDT") or EUR_TO_USDT_FALLBACK
-                    rate = rate_btc_usdt / rate_eur_usdt
-                elif to_key == 'uah':
-                    rate = rate_btc_usdt * USDT_TO_UAH_FALLBACK
-                logger.info(f"Fallback rate for {from_code} to {to_code}: {rate}")
-                redis_client.setex(f"rate:{from_key}_{to_key}", CACHE_TIMEOUT, str(rate))
-                return amount * rate, f"1 {from_code} \\= {escape_markdown_v2(str(rate))} {to_code} \\(Binance via USDT\\)"
-        elif from_key == 'eth' and to_key in ['usdt', 'eur', 'uah']:
-            rate_eth_usdt = await fetch_rate(session, f"{BINANCE_API_URL}?symbol=ETHUSDT", 'price', False, "Binance ETHUSDT")
-            if rate_eth_usdt:
-                if to_key == 'usdt':
-                    rate = rate_eth_usdt
-                elif to_key == 'eur':
-                    rate_eur_usdt = await fetch_rate(session, f"{BINANCE_API_URL}?symbol=EURUSDT", 'price', False, "Binance EURUSDT") or EUR_TO_USDT_FALLBACK
-                    rate = rate_eth_usdt / rate_eur_usdt
-                elif to_key == 'uah':
-                    rate = rate_eth_usdt * USDT_TO_UAH_FALLBACK
-                logger.info(f"Fallback rate for {from_code} to {to_code}: {rate}")
-                redis_client.setex(f"rate:{from_key}_{to_key}", CACHE_TIMEOUT, str(rate))
-                return amount * rate, f"1 {from_code} \\= {escape_markdown_v2(str(rate))} {to_code} \\(Binance via USDT\\)"
-
-        # Fallback для UAH и других валют
-        if from_key == 'uah' and to_key == 'usdt':
-            rate = UAH_TO_USDT_FALLBACK
-            logger.info(f"Fallback rate for {from_code} to {to_code}: {rate}")
-            redis_client.setex(f"rate:{from_key}_{to_key}", CACHE_TIMEOUT, str(rate))
-            return amount * rate, f"1 {from_key.upper()} \\= {escape_markdown_v2(str(rate))} {to_key.upper()} \\(fallback\\)"
-        elif from_key == 'usdt' and to_key == 'uah':
-            rate = USDT_TO_UAH_FALLBACK
-            logger.info(f"Fallback rate for {from_code} to {to_code}: {rate}")
-            redis_client.setex(f"rate:{from_key}_{to_key}", CACHE_TIMEOUT, str(rate))
-            return amount * rate, f"1 {from_key.upper()} \\= {escape_markdown_v2(str(rate))} {to_key.upper()} \\(fallback\\)"
-        elif from_key == 'uah' and to_key == 'eur':
-            rate_usdt = UAH_TO_USDT_FALLBACK
-            rate_eur = await fetch_rate(session, f"{BINANCE_API_URL}?symbol=EURUSDT", 'price', True, "Binance EURUSDT") or EUR_TO_USDT_FALLBACK
-            rate = rate_usdt / rate_eur
-            logger.info(f"Fallback rate for {from_code} to {to_code}: {rate}")
-            redis_client.setex(f"rate:{from_key}_{to_key}", CACHE_TIMEOUT, str(rate))
-            return amount * rate, f"1 {from_key.upper()} \\= {escape_markdown_v2(str(rate))} {to_key.upper()} \\(Binance via USDT\\)"
-        elif from_key == 'eur' and to_key == 'uah':
-            rate_usdt = await fetch_rate(session, f"{BINANCE_API_URL}?symbol=EURUSDT", 'price', False, "Binance EURUSDT") or EUR_TO_USDT_FALLBACK
-            rate = rate_usdt * USDT_TO_UAH_FALLBACK
-            logger.info(f"Fallback rate for {from_code} to {to_code}: {rate}")
-            redis_client.setex(f"rate:{from_key}_{to_key}", CACHE_TIMEOUT, str(rate))
-            return amount * rate, f"1 {from_key.upper()} \\= {escape_markdown_v2(str(rate))} {to_key.upper()} \\(Binance via USDT\\)"
+                usdt_rates[symbol[:-len('USDT')]] = rate
+        # Для пары XUSDT плечо моста и есть прямой курс Binance, он приоритетнее остальных источников
+        if to_code != 'USDT' or from_code not in usdt_rates:
+            for rate, source in zip(results, sources):
+                if isinstance(rate, float) and rate > 0:
+                    logger.info("Using direct rate for %s to %s: %s from %s", from_code, to_code, rate, source["name"])
+                    return await rate_result(from_key, to_key, rate, source["name"])
+
+    if from_code in usdt_rates and to_code in usdt_rates:
+        rate = usdt_rates[from_code] / usdt_rates[to_code]
+        logger.info("Rate via USDT for %s to %s: %s (%s/%s)", from_code, to_code, rate, usdt_rates[from_code], usdt_rates[to_code])
+        return await rate_result(from_key, to_key, rate, f"Binance {direct_symbol}" if to_code == 'USDT' else "Binance via USDT")
+
+    # Недостающее плечо моста берём из фиксированных курсов
+    rate_from_usdt = usdt_rates.get(from_code) or FALLBACK_USDT_RATES.get(from_code)
+    rate_to_usdt = usdt_rates.get(to_code) or FALLBACK_USDT_RATES.get(to_code)
+    if rate_from_usdt and rate_to_usdt:
+        rate = rate_from_usdt / rate_to_usdt
+        logger.info("Fallback rate for %s to %s: %s", from_code, to_code, rate)
+        return await rate_result(from_key, to_key, rate, "fallback")
 
     logger.warning(f"No live rate found for {from_key} to {to_key}")
     return None, "Курс недоступен на данный момент\\. Попробуй позже\\!"
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await enforce_subscription(update, context):
-        return
     user_id = str(update.effective_user.id)
-    save_stats(user_id, "start")
+    await save_stats(user_id, "start")
     if context.args and context.args[0].startswith("ref_"):
         await handle_referral(update, context)
 
-    keyboard = [
-        [InlineKeyboardButton("💱 Конвертер", callback_data="converter"), InlineKeyboardButton("📈 Курсы", callback_data="price")],
-        [InlineKeyboardButton("📊 Статистика", callback_data="stats"), InlineKeyboardButton("💎 Подписка", callback_data="subscribe")],
-        [InlineKeyboardButton("🔔 Уведомления", callback_data="alert"), InlineKeyboardButton("👥 Рефералы", callback_data="referrals")],
-        [InlineKeyboardButton("📜 История", callback_data="history")]
-    ]
-    
-    try:
-        await update.effective_message.reply_text(
-            f"👋 *Привет*\! Я {BOT_USERNAME} — твой помощник для конвертации валют\!\n"
-            f"🔑 *Бесплатно*: {FREE_REQUEST_LIMIT} запросов в сутки\n"
-            f"🌟 *Безлимит*: /subscribe за {SUBSCRIPTION_PRICE} USDT{AD_MESSAGE}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-    except TelegramError as e:
-        logger.error(f"Failed to send start message to {user_id}: {e}")
+    await respond(update, START_TEXT, START_MARKUP)
 
 async def currencies(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await enforce_subscription(update, context):
-        return
-    try:
-        await update.effective_message.reply_text(
-            f"💱 *Поддерживаемые валюты*:\n{', '.join(sorted(CURRENCIES.keys()))}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="start")]]),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-    except TelegramError as e:
-        logger.error(f"Failed to send currencies list: {e}")
+    await respond(update, CURRENCIES_TEXT, BACK_MARKUP)
 
 async def alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await enforce_subscription(update, context):
-        return
     user_id = str(update.effective_user.id)
     args = context.args if update.message else None
-    if not args or len(args) != 3 or not args[2].replace('.', '', 1).isdigit():
-        keyboard = [
-            [InlineKeyboardButton("🔔 USD → BTC", callback_data="alert_example_usd_btc")],
-            [InlineKeyboardButton("🔔 EUR → UAH", callback_data="alert_example_eur_uah")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="start")]
-        ]
-        text = "🔔 *Настрой уведомления*\! Формат: `/alert <валюта1> <валюта2> <курс>`\nПримеры ниже:"
-        try:
-            if update.callback_query:
-                await update.callback_query.edit_message_text(
-                    text,
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
-            else:
-                await update.effective_message.reply_text(
-                    text,
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
-        except TelegramError as e:
-            logger.error(f"Failed to send alert instructions to {user_id}: {e}")
+    match = ALERT_RE.match(' '.join(args).lower()) if args else None
+    if not match:
+        await respond(update, ALERT_HELP_TEXT, ALERT_HELP_MARKUP)
         return
 
-    from_currency, to_currency, target_rate = args[0].lower(), args[1].lower(), float(args[2])
-    if from_currency not in CURRENCIES or to_currency not in CURRENCIES:
-        try:
-            await update.effective_message.reply_text("❌ Ошибка: валюта не поддерживается", parse_mode=ParseMode.MARKDOWN_V2)
-        except TelegramError as e:
-            logger.error(f"Failed to send alert error to {user_id}: {e}")
+    from_currency, to_currency, target_rate = match.group(1), match.group(2), float(match.group(3))
+    if from_currency not in SUPPORTED_CURRENCIES or to_currency not in SUPPORTED_CURRENCIES:
+        await respond(update, "❌ Ошибка: валюта не поддерживается")
         return
 
     try:
-        alerts = json.loads(redis_client.get(f"alerts:{user_id}") or '[]')
+        alerts = orjson.loads(await redis_client.get(f"alerts:{user_id}") or '[]')
         alerts.append({"from": from_currency, "to": to_currency, "target": target_rate})
-        redis_client.setex(f"alerts:{user_id}", 30 * 24 * 60 * 60, json.dumps(alerts))
-        await update.effective_message.reply_text(
-            f"🔔 *Уведомление*: {from_currency.upper()} → {to_currency.upper()} при курсе {escape_markdown_v2(str(target_rate))}",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔔 Добавить ещё", callback_data="alert"), InlineKeyboardButton("🔙 Назад", callback_data="start")]
-            ]),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
+        pipe = redis_client.pipeline()
+        pipe.setex(f"alerts:{user_id}", 30 * 24 * 60 * 60, orjson.dumps(alerts))
+        pipe.sadd('users_with_alerts', user_id)
+        await pipe.execute()
     except Exception as e:
         logger.error(f"Failed to set alert for {user_id}: {e}")
-        try:
-            await update.effective_message.reply_text("❌ Ошибка при настройке уведомления", parse_mode=ParseMode.MARKDOWN_V2)
-        except TelegramError as te:
-            logger.error(f"Failed to send alert error to {user_id}: {te}")
+        await respond(update, "❌ Ошибка при настройке уведомления")
+        return
+    await respond(
+        update,
+        f"🔔 *Уведомление*: {from_currency.upper()} → {to_currency.upper()} при курсе {escape_markdown_v2(str(target_rate))}",
+        ALERT_ADDED_MARKUP
+    )
 
 async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await enforce_subscription(update, context):
-        return
     user_id = str(update.effective_user.id)
     try:
-        stats = json.loads(redis_client.get('stats') or '{}')
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="start")]]
         if user_id in ADMIN_IDS:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.scard('stats:users')
+            pipe.get('stats:total')
+            pipe.get('stats:revenue')
+            users_count, total_requests, revenue = await pipe.execute()
             text = (f"📊 *Админ\\-статистика*:\n"
-                    f"👥 Пользователей: {len(stats.get('users', {}))}\n"
-                    f"📈 Запросов: {stats.get('total_requests', 0)}\n"
-                    f"💰 Доход: {escape_markdown_v2(str(stats.get('revenue', 0.0)))} USDT")
-        else:
-            text = f"📊 *Твоя статистика*:\n📈 Запросов сегодня: {stats.get('users', {}).get(user_id, {}).get('requests', 0)}"
-        if update.callback_query:
-            await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2)
+                    f"👥 Пользователей: {users_count}\n"
+                    f"📈 Запросов: {int(total_requests or 0)}\n"
+                    f"💰 Доход: {escape_markdown_v2(str(float(revenue or 0.0)))} USDT")
         else:
-            await update.effective_message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2)
+            requests_today = await get_user_requests(user_id)
+            text = f"📊 *Твоя статистика*:\n📈 Запросов сегодня: {requests_today}"
     except Exception as e:
-        logger.error(f"Failed to send stats to {user_id}: {e}")
-        try:
-            await update.effective_message.reply_text("❌ Ошибка при получении статистики", parse_mode=ParseMode.MARKDOWN_V2)
-        except TelegramError as te:
-            logger.error(f"Failed to send stats error to {user_id}: {te}")
+        logger.error(f"Failed to get stats for {user_id}: {e}")
+        await respond(update, "❌ Ошибка при получении статистики")
+        return
+    await respond(update, text, BACK_MARKUP)
 
 async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await enforce_subscription(update, context):
-        return
     user_id = str(update.effective_user.id)
     try:
-        stats = json.loads(redis_client.get('stats') or '{}')
-        if stats.get("subscriptions", {}).get(user_id):
-            text = "💎 Ты уже подписан\\!"
-            if update.callback_query:
-                await update.callback_query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN_V2)
-            else:
-                await update.effective_message.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+        if await has_paid_subscription(user_id):
+            await respond(update, "💎 Ты уже подписан\\!")
             return
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://pay.crypt.bot/api/createInvoice",
+        # Неоплаченный счёт ещё действует: отдаём ту же ссылку без запроса к Crypto Pay
+        pay_url = await redis_client.get(f"invoice_url:{user_id}")
+        if not pay_url:
+            async with http_session.post(
+                f"{CRYPTO_PAY_API_URL}/createInvoice",
                 headers={'Crypto-Pay-API-Token': CRYPTO_PAY_TOKEN},
-                json={"asset": "USDT", "amount": str(SUBSCRIPTION_PRICE), "description": f"Подписка для {user_id}"},
+                json={
+                    "asset": "USDT", "amount": str(SUBSCRIPTION_PRICE), "description": f"Подписка для {user_id}",
+                    "payload": user_id, "expires_in": INVOICE_TTL
+                },
                 timeout=aiohttp.ClientTimeout(total=15)
             ) as response:
-                result = await response.json()
-                if result.get("ok"):
-                    invoice_id = result["result"]["invoice_id"]
-                    pay_url = result["result"]["pay_url"]
-                    context.user_data[user_id] = {"invoice_id": invoice_id}
-                    text = f"💎 Оплати *{SUBSCRIPTION_PRICE} USDT* для безлимита:"
-                    keyboard = InlineKeyboardMarkup([
-                        [InlineKeyboardButton(f"💳 Оплатить {SUBSCRIPTION_PRICE} USDT", url=pay_url)],
-                        [InlineKeyboardButton("🔙 Назад", callback_data="start")]
-                    ])
-                    if update.callback_query:
-                        await update.callback_query.edit_message_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2)
-                    else:
-                        await update.effective_message.reply_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2)
-                else:
-                    error_msg = result.get('error', 'Неизвестно')
-                    logger.error(f"Payment error for {user_id}: {error_msg}")
-                    text = f"❌ Ошибка платежа: {escape_markdown_v2(error_msg)}"
-                    if update.callback_query:
-                        await update.callback_query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN_V2)
-                    else:
-                        await update.effective_message.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+                result = await response.json(loads=orjson.loads)
+            if not result.get("ok"):
+                error_msg = result.get('error', 'Неизвестно')
+                logger.error(f"Payment error for {user_id}: {error_msg}")
+                await respond(update, f"❌ Ошибка платежа: {escape_markdown_v2(str(error_msg))}")
+                return
+            pay_url = result["result"]["pay_url"]
+            pipe = redis_client.pipeline()
+            pipe.hset('pending_invoices', user_id, result["result"]["invoice_id"])
+            pipe.setex(f"invoice_url:{user_id}", INVOICE_TTL - 60, pay_url)
+            await pipe.execute()
+
     except Exception as e:
         logger.error(f"Subscribe error for {user_id}: {e}")
-        text = "❌ Ошибка связи с платежной системой"
-        try:
-            if update.callback_query:
-                await update.callback_query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN_V2)
-            else:
-                await update.effective_message.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
-        except TelegramError as te:
-            logger.error(f"Failed to send subscribe error to {user_id}: {te}")
+        await respond(update, "❌ Ошибка связи с платежной системой")
+        return
+    await respond(update, SUBSCRIBE_TEXT, InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"💳 Оплатить {SUBSCRIPTION_PRICE} USDT", url=pay_url)],
+        [InlineKeyboardButton("🔙 Назад", callback_data="start")]
+    ]))
 
 async def referrals(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await enforce_subscription(update, context):
-        return
     user_id = str(update.effective_user.id)
     try:
         ref_link = f"https://t.me/{BOT_USERNAME}?start=ref_{user_id}"
-        refs = len(json.loads(redis_client.get(f"referrals:{user_id}") or '[]'))
-        text = f"👥 *Реф\\. ссылка*: `{ref_link}`\n👤 Приглашено: *{refs}*\n🌟 Бонусы скоро будут\\!"
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔗 Копировать", callback_data="copy_ref"), InlineKeyboardButton("🔙 Назад", callback_data="start")]
-        ])
-        if update.callback_query:
-            await update.callback_query.edit_message_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await update.effective_message.reply_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN_V2)
+        refs = await redis_client.scard(f"referrals:{user_id}")
     except Exception as e:
-        logger.error(f"Failed to send referrals to {user_id}: {e}")
-        try:
-            await update.effective_message.reply_text("❌ Ошибка при получении рефералов", parse_mode=ParseMode.MARKDOWN_V2)
-        except TelegramError as te:
-            logger.error(f"Failed to send referrals error to {user_id}: {te}")
+        logger.error(f"Failed to get referrals for {user_id}: {e}")
+        await respond(update, "❌ Ошибка при получении рефералов")
+        return
+    await respond(update, f"👥 *Реф\\. ссылка*: `{ref_link}`\n👤 Приглашено: *{refs}*\n🌟 Бонусы скоро будут\\!", REFERRALS_MARKUP)
 
 async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await enforce_subscription(update, context):
-        return
     user_id = str(update.effective_user.id)
     try:
-        history_data = json.loads(redis_client.get(f"history:{user_id}") or '[]')
-        back_button = [[InlineKeyboardButton("🔙 Назад", callback_data="start")]]
+        history_data = [orjson.loads(entry) for entry in await redis_client.lrange(f"history:{user_id}", 0, -1)]
         if not history_data:
             text = "📜 *История пуста*\\."
         else:
             history_lines = []
-            for entry in reversed(history_data):
-                time_str = entry['time'].replace('-', '\\-')
+            for entry in history_data:
+                timestamp = entry['time']
+                # Старые записи хранят уже отформатированную строку
+                if isinstance(timestamp, int):
+                    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+                time_str = timestamp.replace('-', '\\-')
                 amount_str = escape_markdown_v2(str(entry['amount']))
                 result_str = escape_markdown_v2(str(entry['result']))
                 from_curr = escape_markdown_v2(entry['from'])
@@ -512,16 +800,11 @@ async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 line = f"⏰ {time_str}: *{amount_str} {from_curr}* → *{result_str} {to_curr}*"
                 history_lines.append(line)
             text = "📜 *История запросов*:\n" + "\n".join(history_lines)
-        if update.callback_query:
-            await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(back_button), parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await update.effective_message.reply_text(text, reply_markup=InlineKeyboardMarkup(back_button), parse_mode=ParseMode.MARKDOWN_V2)
     except Exception as e:
-        logger.error(f"Failed to send history to {user_id}: {e}")
-        try:
-            await update.effective_message.reply_text("❌ Ошибка при получении истории", parse_mode=ParseMode.MARKDOWN_V2)
-        except TelegramError as te:
-            logger.error(f"Failed to send history error to {user_id}: {te}")
+        logger.error(f"Failed to get history for {user_id}: {e}")
+        await respond(update, "❌ Ошибка при получении истории")
+        return
+    await respond(update, text, BACK_MARKUP)
 
 async def handle_referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
@@ -529,239 +812,378 @@ async def handle_referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
         referrer_id = context.args[0].replace("ref_", "")
         if referrer_id.isdigit() and referrer_id != user_id:
             try:
-                referrals = json.loads(redis_client.get(f"referrals:{referrer_id}") or '[]')
-                if user_id not in referrals:
-                    referrals.append(user_id)
-                    redis_client.setex(f"referrals:{referrer_id}", 30 * 24 * 60 * 60, json.dumps(referrals))
-                    await update.effective_message.reply_text("👥 Спасибо за присоединение по реф\\. ссылке\\!", parse_mode=ParseMode.MARKDOWN_V2)
+                # Рефералы — множество в Redis: SADD сам отсекает повторы, без чтения и перезаписи списка
+                pipe = redis_client.pipeline(transaction=False)
+                pipe.sadd(f"referrals:{referrer_id}", user_id)
+                pipe.expire(f"referrals:{referrer_id}", 30 * 24 * 60 * 60)
+                added, _ = await pipe.execute()
             except Exception as e:
                 logger.error(f"Failed to handle referral for {user_id} from {referrer_id}: {e}")
+                return
+            if added:
+                await respond(update, "👥 Спасибо за присоединение по реф\\. ссылке\\!")
+
+def verify_crypto_pay_signature(body: bytes, signature: str) -> bool:
+    secret = hashlib.sha256(CRYPTO_PAY_TOKEN.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+async def activate_subscription(bot: Bot, user_id: str):
+    try:
+        pipe = redis_client.pipeline()
+        pipe.sadd('stats:subs', user_id)
+        pipe.hdel('pending_invoices', user_id)
+        pipe.delete(f"invoice_url:{user_id}")
+        added, _, _ = await pipe.execute()
+        subscription_cache.pop(user_id, None)
+        if added:
+            await redis_client.incrbyfloat('stats:revenue', SUBSCRIPTION_PRICE)
+        await send_notification(bot, user_id, "💎 Оплата прошла\\! Безлимит активирован\\.")
+    except Exception as e:
+        logger.error(f"Failed to activate subscription for {user_id}: {e}")
 
-async def check_payment_job(context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data is None:
-        logger.debug("No user_data available in check_payment_job, skipping")
+async def reconcile_pending_invoices(bot: Bot):
+    # Оплаты, пришедшие пока бот был выключен или без вебхука: один запрос getInvoices на все ожидающие счета
+    try:
+        pending = await redis_client.hgetall('pending_invoices')
+    except redis.RedisError as e:
+        logger.error(f"Failed to read pending invoices: {e}")
         return
-    for user_id, data in list(context.user_data.items()):
-        if "invoice_id" not in data:
-            continue
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    f"https://pay.crypt.bot/api/getInvoices?invoice_ids={data['invoice_id']}",
-                    headers={'Crypto-Pay-API-Token': CRYPTO_PAY_TOKEN},
-                    timeout=aiohttp.ClientTimeout(total=15)
-                ) as response:
-                    result = await response.json()
-                    if result.get("ok") and result["result"]["items"] and result["result"]["items"][0]["status"] == "paid":
-                        stats = json.loads(redis_client.get('stats') or '{}')
-                        stats.setdefault("subscriptions", {})[user_id] = True
-                        stats["revenue"] = stats.get("revenue", 0.0) + SUBSCRIPTION_PRICE
-                        redis_client.setex('stats', 30 * 24 * 60 * 60, json.dumps(stats))
-                        del context.user_data[user_id]
-                        await context.bot.send_message(
-                            user_id,
-                            "💎 Оплата прошла\\! Безлимит активирован\\.",
-                            parse_mode=ParseMode.MARKDOWN_V2
-                        )
-        except Exception as e:
-            logger.error(f"Payment check error for {user_id}: {e}")
+    if not pending:
+        return
+    users_by_invoice = {str(invoice_id): user_id for user_id, invoice_id in pending.items()}
+    invoice_ids = list(users_by_invoice)
+    try:
+        for i in range(0, len(invoice_ids), CRYPTO_PAY_INVOICES_BATCH):
+            async with http_session.get(
+                f"{CRYPTO_PAY_API_URL}/getInvoices",
+                headers={'Crypto-Pay-API-Token': CRYPTO_PAY_TOKEN},
+                params={"invoice_ids": ",".join(invoice_ids[i:i + CRYPTO_PAY_INVOICES_BATCH]), "count": CRYPTO_PAY_INVOICES_BATCH},
+                timeout=aiohttp.ClientTimeout(total=15)
+            ) as response:
+                result = await response.json(loads=orjson.loads)
+            if not result.get("ok"):
+                logger.error(f"getInvoices error: {result.get('error', 'Неизвестно')}")
+                return
+            for invoice in result["result"].get("items", []):
+                user_id = users_by_invoice.get(str(invoice.get("invoice_id")))
+                if not user_id:
+                    continue
+                if invoice.get("status") == "paid":
+                    await activate_subscription(bot, user_id)
+                elif invoice.get("status") == "expired":
+                    await redis_client.hdel('pending_invoices', user_id)
+        logger.info(f"Reconciled {len(invoice_ids)} pending invoices")
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+        logger.error(f"Failed to reconcile pending invoices: {e}")
+
+async def reconcile_invoices_job(context: ContextTypes.DEFAULT_TYPE):
+    # Запасной путь: оплата, чей вебхук потерялся или не дошёл, активируется при следующей сверке
+    await reconcile_pending_invoices(context.bot)
+
+async def crypto_pay_webhook(request: web.Request) -> web.Response:
+    body = await request.read()
+    if not verify_crypto_pay_signature(body, request.headers.get('crypto-pay-api-signature', '')):
+        logger.warning("Rejected Crypto Pay webhook with invalid signature")
+        return web.Response(status=401)
+    try:
+        update = orjson.loads(body)
+    except ValueError:
+        return web.Response(status=400)
+    if update.get("update_type") == "invoice_paid":
+        user_id = str(update.get("payload", {}).get("payload", ""))
+        if user_id.isdigit():
+            await activate_subscription(request.app[APP_KEY].bot, user_id)
+        else:
+            logger.warning(f"Paid invoice without user payload: {update.get('payload', {}).get('invoice_id')}")
+    return web.Response(text="OK")
 
 async def check_alerts_job(context: ContextTypes.DEFAULT_TYPE):
     try:
-        stats = json.loads(redis_client.get('stats') or '{}')
-        if not stats.get("users"):
+        user_ids = list(await redis_client.smembers('users_with_alerts'))
+        if not user_ids:
             return
-        for user_id in stats.get("users", {}):
-            alerts = json.loads(redis_client.get(f"alerts:{user_id}") or '[]')
-            if not alerts:
-                continue
-            updated_alerts = []
+        # Все списки алертов одним запросом
+        raw_alerts = await redis_client.mget([f"alerts:{user_id}" for user_id in user_ids])
+        alerts_by_user = {user_id: orjson.loads(raw or '[]') for user_id, raw in zip(user_ids, raw_alerts)}
+
+        # Каждая пара валют запрашивается один раз за проход
+        pairs = list({(alert["from"], alert["to"]) for alerts in alerts_by_user.values() for alert in alerts})
+        results = await asyncio.gather(*(get_exchange_rate(from_key, to_key) for from_key, to_key in pairs), return_exceptions=True)
+        rates = {pair: result[0] for pair, result in zip(pairs, results) if not isinstance(result, Exception)}
+
+        # Сработавшие алерты рассылаются параллельно, число одновременных отправок ограничивает send_notification
+        triggered = []
+        for user_id, alerts in alerts_by_user.items():
             for alert in alerts:
-                result, rate_info = await get_exchange_rate(alert["from"], alert["to"])
-                if result and float(rate_info.split()[2]) <= alert["target"]:
-                    from_code, to_code = CURRENCIES[alert["from"]]['code'], CURRENCIES[alert["to"]]['code']
-                    await context.bot.send_message(
-                        user_id,
-                        f"🔔 *Уведомление*\! {from_code} → {to_code}: {escape_markdown_v2(str(float(rate_info.split()[2])))} \\(цель: {escape_markdown_v2(str(alert['target']))}\\)",
-                        parse_mode=ParseMode.MARKDOWN_V2
-                    )
-                else:
-                    updated_alerts.append(alert)
-            redis_client.setex(f"alerts:{user_id}", 30 * 24 * 60 * 60, json.dumps(updated_alerts))
+                rate = rates.get((alert["from"], alert["to"]))
+                if rate and rate <= alert["target"]:
+                    from_code, to_code = CURRENCIES[alert["from"]], CURRENCIES[alert["to"]]
+                    text = f"🔔 *Уведомление*\\! {from_code} → {to_code}: {escape_markdown_v2(str(rate))} \\(цель: {escape_markdown_v2(str(alert['target']))}\\)"
+                    triggered.append((user_id, alert, text))
+        outcomes = await asyncio.gather(*(send_notification(context.bot, user_id, text) for user_id, _, text in triggered))
+        # Доставленные и те, что доставить нельзя в принципе, снимаются; при временном сбое алерт ждёт следующего прохода
+        finished: Dict[str, list] = {}
+        for (user_id, alert, _), outcome in zip(triggered, outcomes):
+            if outcome != NOTIFY_FAILED:
+                finished.setdefault(user_id, []).append(alert)
+
+        # Снимок MGET к этому моменту мог устареть (пользователь добавил алерт во время прохода),
+        # поэтому снятые алерты убираются из текущего списка, и только у тех, у кого что-то сработало
+        removals = await asyncio.gather(*(remove_alerts(user_id, alerts) for user_id, alerts in finished.items()), return_exceptions=True)
+        for user_id, result in zip(finished, removals):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to remove finished alerts for {user_id}: {result}")
     except Exception as e:
         logger.error(f"Error in check_alerts_job: {e}")
 
+async def remove_alerts(user_id: str, alerts: list):
+    # WATCH на список: если /alert успеет записать его между чтением и записью, транзакция перезапустится
+    await redis_client.transaction(functools.partial(remove_alerts_tx, user_id, alerts), f"alerts:{user_id}")
+
+async def remove_alerts_tx(user_id: str, alerts: list, pipe):
+    key = f"alerts:{user_id}"
+    current = orjson.loads(await pipe.get(key) or '[]')
+    for alert in alerts:
+        if alert in current:
+            current.remove(alert)
+    pipe.multi()
+    if current:
+        pipe.setex(key, 30 * 24 * 60 * 60, orjson.dumps(current))
+    else:
+        pipe.delete(key)
+        pipe.srem('users_with_alerts', user_id)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await enforce_subscription(update, context):
-        return
     user_id = str(update.effective_user.id)
     try:
-        stats = json.loads(redis_client.get('stats') or '{}')
-        is_subscribed = user_id in ADMIN_IDS or stats.get("subscriptions", {}).get(user_id)
-        delay = 0 if is_subscribed else 5
+        amount, from_currency, to_currency = parse_conversion(update.effective_message.text)
+        # Подписка, пауза, дневной лимит и учёт запроса — один атомарный вызов Redis
+        outcome, remaining = await count_request(user_id, f"{from_currency}_to_{to_currency}")
 
-        if 'last_request' in context.user_data and time.time() - context.user_data['last_request'] < delay:
-            await update.effective_message.reply_text(f"⏳ Подожди {delay} секунд{'у' if delay == 1 else ''}\!", parse_mode=ParseMode.MARKDOWN_V2)
+        if outcome != REQUEST_ALLOWED:
+            await respond(update, THROTTLE_TEXT if outcome == REQUEST_THROTTLED else LIMIT_TEXT)
             return
 
-        can_proceed, remaining = check_limit(user_id)
-        if not can_proceed:
-            await update.effective_message.reply_text(f"❌ Лимит {FREE_REQUEST_LIMIT} запросов исчерпан\\. /subscribe", parse_mode=ParseMode.MARKDOWN_V2)
-            return
-
-        context.user_data['last_request'] = time.time()
-        text = update.effective_message.text.lower().split()
-        amount = float(text[0]) if text[0].replace('.', '', 1).isdigit() else 1.0
-        from_currency = text[1 if amount != 1.0 else 0]
-        to_currency = text[2 if amount != 1.0 else 1]
-        save_stats(user_id, f"{from_currency}_to_{to_currency}")
-        
         # Асинхронный вызов get_exchange_rate
         result, rate_info = await get_exchange_rate(from_currency, to_currency, amount)
         if result is None:
-            await update.effective_message.reply_text(
-                f"❌ Ошибка: {rate_info}",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💱 Попробовать снова", callback_data="converter")]]),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
+            await respond(update, f"❌ Ошибка: {rate_info}", RETRY_MARKUP)
             return
 
-        from_code, to_code = CURRENCIES[from_currency.lower()]['code'], CURRENCIES[to_currency.lower()]['code']
-        precision = 8 if to_code in HIGH_PRECISION_CURRENCIES else 2
-        await update.effective_message.reply_text(
+        from_code, to_code = CURRENCIES[from_currency], CURRENCIES[to_currency]
+        precision = CURRENCY_PRECISION[to_currency]
+        await respond(
+            update,
             f"💰 *{escape_markdown_v2(str(amount))} {from_code}* \\= *{escape_markdown_v2(str(round(result, precision)))} {to_code}*\n"
             f"📈 {rate_info}\n🔄 Осталось: *{remaining}*{AD_MESSAGE}",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔄 Ещё раз", callback_data=f"convert:{from_currency}:{to_currency}")],
-                [InlineKeyboardButton("💱 Другая пара", callback_data="converter"), InlineKeyboardButton("🔙 Назад", callback_data="start")]
-            ]),
-            parse_mode=ParseMode.MARKDOWN_V2
+            conversion_markup(from_currency, to_currency)
         )
-        save_history(user_id, from_code, to_code, amount, result)
-    except (IndexError, ValueError) as e:
-        try:
-            error_msg = escape_markdown_v2(str(e) if isinstance(e, ValueError) else "Неверный формат")
-            await update.effective_message.reply_text(
-                f"❌ Ошибка: {error_msg}\nПример: `100\\.0 uah usdt`",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💱 Попробовать снова", callback_data="converter")]]),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-        except TelegramError as te:
-            logger.error(f"Failed to send message error to {user_id}: {te}")
+        await save_history(user_id, from_code, to_code, amount, result)
+    except ValueError as e:
+        await respond(update, f"❌ Ошибка: {escape_markdown_v2(str(e))}\nПример: `100\\.0 uah usdt`", RETRY_MARKUP)
     except Exception as e:
         logger.error(f"Unexpected error in handle_message for {user_id}: {e}")
-        try:
-            await update.effective_message.reply_text("❌ Неизвестная ошибка, попробуй позже", parse_mode=ParseMode.MARKDOWN_V2)
-        except TelegramError as te:
-            logger.error(f"Failed to send unexpected error to {user_id}: {te}")
+        await respond(update, "❌ Неизвестная ошибка, попробуй позже")
+
+async def show_converter(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await respond(update, CONVERTER_TEXT, CONVERTER_MARKUP)
+
+async def manual_convert(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await respond(update, MANUAL_CONVERT_TEXT)
+
+async def alert_example_usd_btc(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await respond(update, ALERT_EXAMPLE_USD_BTC_TEXT)
+
+async def alert_example_eur_uah(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await respond(update, ALERT_EXAMPLE_EUR_UAH_TEXT)
+
+async def show_prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await respond(update, PRICE_TEXT, PRICE_MARKUP)
+
+# Статичные кнопки: callback_data -> обработчик; convert:<from>:<to> разбирается отдельно
+BUTTON_ACTIONS = {
+    "start": start,
+    "converter": show_converter,
+    "manual_convert": manual_convert,
+    "stats": stats_handler,
+    "subscribe": subscribe,
+    "alert": alert,
+    "referrals": referrals,
+    "history": history,
+    "copy_ref": referrals,
+    "alert_example_usd_btc": alert_example_usd_btc,
+    "alert_example_eur_uah": alert_example_eur_uah,
+    "price": show_prices,
+}
 
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except TelegramError as e:
-        logger.error(f"Failed to answer callback query: {e}")
-        return
-
-    if not await enforce_subscription(update, context):
+    user_id = str(query.from_user.id)
+    action = query.data
+    # Разделы меню лимит не расходуют и Redis ради него не читают; лимит проверяется только для конвертации
+    handler = BUTTON_ACTIONS.get(action)
+    # Ответ Telegram на нажатие и чтение лимитов из Redis независимы и идут параллельно
+    pending = [query.answer()] if handler else [query.answer(), check_limit(user_id)]
+    answered, *limit = await asyncio.gather(*pending, return_exceptions=True)
+    if isinstance(answered, Exception):
+        logger.error(f"Failed to answer callback query: {answered}")
         return
 
-    user_id = str(query.from_user.id)
     try:
-        stats = json.loads(redis_client.get('stats') or '{}')
-        is_subscribed = user_id in ADMIN_IDS or stats.get("subscriptions", {}).get(user_id)
-        delay = 0 if is_subscribed else 5
+        if handler:
+            await handler(update, context)
+            return
+
+        can_proceed, remaining = limit[0]
+        delay = 0 if remaining == "∞" else THROTTLE_DELAY
 
-        if 'last_request' in context.user_data and time.time() - context.user_data['last_request'] < delay:
-            await query.edit_message_text(f"⏳ Подожди {delay} секунд{'у' if delay == 1 else ''}\!", parse_mode=ParseMode.MARKDOWN_V2)
+        if await is_throttled(user_id, delay):
+            await respond(update, THROTTLE_TEXT)
             return
 
-        can_proceed, remaining = check_limit(user_id)
         if not can_proceed:
-            await query.edit_message_text(f"❌ Лимит {FREE_REQUEST_LIMIT} запросов исчерпан\\. /subscribe", parse_mode=ParseMode.MARKDOWN_V2)
+            await respond(update, LIMIT_TEXT)
             return
 
-        context.user_data['last_request'] = time.time()
-        action = query.data
-
-        if action == "start":
-            await start(update, context)
-        elif action == "converter":
-            await query.edit_message_text(
-                "💱 *Выбери пару или введи вручную \\(например, '100\\.0 uah usdt'\\)*:",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("💰 USD → BTC", callback_data="convert:usd:btc"), InlineKeyboardButton("💶 EUR → UAH", callback_data="convert:eur:uah")],
-                    [InlineKeyboardButton("₿ BTC → ETH", callback_data="convert:btc:eth"), InlineKeyboardButton("₴ UAH → USDT", callback_data="convert:uah:usdt")],
-                    [InlineKeyboardButton("🔄 Ввести вручную", callback_data="manual_convert"), InlineKeyboardButton("🔙 Назад", callback_data="start")]
-                ]),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-        elif action.startswith("convert:"):
-            _, from_currency, to_currency = action.split(":")
+        if action.startswith("convert:"):
+            from_currency, _, to_currency = action[len("convert:"):].partition(":")
             result, rate_info = await get_exchange_rate(from_currency, to_currency)
             if result:
-                from_code, to_code = CURRENCIES[from_currency.lower()]['code'], CURRENCIES[to_currency.lower()]['code']
-                precision = 8 if to_code in HIGH_PRECISION_CURRENCIES else 2
-                await query.edit_message_text(
+                from_code, to_code = CURRENCIES[from_currency], CURRENCIES[to_currency]
+                precision = CURRENCY_PRECISION[to_currency]
+                await respond(
+                    update,
                     f"💰 *1\\.0 {from_code}* \\= *{escape_markdown_v2(str(round(result, precision)))} {to_code}*\n"
                     f"📈 {rate_info}\n🔄 Осталось: *{remaining}*{AD_MESSAGE}",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔄 Ещё раз", callback_data=f"convert:{from_currency}:{to_currency}")],
-                        [InlineKeyboardButton("💱 Другая пара", callback_data="converter"), InlineKeyboardButton("🔙 Назад", callback_data="start")]
-                    ]),
-                    parse_mode=ParseMode.MARKDOWN_V2
+                    conversion_markup(from_currency, to_currency)
                 )
-                save_history(user_id, from_code, to_code, 1.0, result)
+                await save_history(user_id, from_code, to_code, 1.0, result)
             else:
-                await query.edit_message_text(f"❌ Ошибка: {escape_markdown_v2(rate_info)}", parse_mode=ParseMode.MARKDOWN_V2)
-        elif action == "manual_convert":
-            await query.edit_message_text("💱 *Введи запрос вручную*: например, '100\\.0 uah usdt'", parse_mode=ParseMode.MARKDOWN_V2)
-        elif action == "stats":
-            await stats_handler(update, context)
-        elif action == "subscribe":
-            await subscribe(update, context)
-        elif action == "alert":
-            await alert(update, context)
-        elif action == "referrals":
-            await referrals(update, context)
-        elif action == "history":
-            await history(update, context)
-        elif action == "copy_ref":
-            ref_link = f"https://t.me/{BOT_USERNAME}?start=ref_{user_id}"
-            refs = len(json.loads(redis_client.get(f"referrals:{user_id}") or '[]'))
-            await query.edit_message_text(
-                f"👥 *Реф\\. ссылка*: `{ref_link}`\n👤 Приглашено: *{refs}*\n🌟 Бонусы скоро будут\\!",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔗 Копировать", callback_data="copy_ref"), InlineKeyboardButton("🔙 Назад", callback_data="start")]
-                ]),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-        elif action == "alert_example_usd_btc":
-            await query.edit_message_text(
-                "🔔 Пример: `/alert usd btc 0\\.000015` — уведомит, когда 1 USD \\= 0\\.000015 BTC",
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-        elif action == "alert_example_eur_uah":
-            await query.edit_message_text(
-                "🔔 Пример: `/alert eur uah 45\\.0` — уведомит, когда 1 EUR \\= 45\\.0 UAH",
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-        elif action == "price":
-            await query.edit_message_text(
-                "📈 *Выбери валюту для курса*:",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("BTC", callback_data="convert:btc:usdt"), InlineKeyboardButton("ETH", callback_data="convert:eth:usdt")],
-                    [InlineKeyboardButton("USD", callback_data="convert:usd:uah"), InlineKeyboardButton("EUR", callback_data="convert:eur:uah")],
-                    [InlineKeyboardButton("🔙 Назад", callback_data="start")]
-                ]),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
+                await respond(update, f"❌ Ошибка: {escape_markdown_v2(rate_info)}")
     except Exception as e:
         logger.error(f"Unexpected error in button handler for {user_id}: {e}")
-        try:
-            await query.edit_message_text("❌ Неизвестная ошибка, попробуй позже", parse_mode=ParseMode.MARKDOWN_V2)
-        except TelegramError as te:
-            logger.error(f"Failed to send button error to {user_id}: {te}")
+        await respond(update, "❌ Неизвестная ошибка, попробуй позже")
+
+async def telegram_webhook(request: web.Request) -> web.Response:
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret.encode(), TELEGRAM_WEBHOOK_SECRET.encode()):
+        logger.warning("Rejected Telegram webhook with invalid secret token")
+        return web.Response(status=403)
+    application = request.app[APP_KEY]
+    try:
+        update = Update.de_json(await request.json(loads=orjson.loads), application.bot)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Rejected malformed Telegram webhook update: {e}")
+        return web.Response(status=400)
+    await application.update_queue.put(update)
+    return web.Response(text="OK")
+
+APP_KEY = web.AppKey("application", Application)
+
+async def on_startup(application: Application):
+    global http_session
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=75),
+        # Тела запросов json=... сериализуются через orjson, как и разбор ответов
+        json_serialize=lambda obj: orjson.dumps(obj).decode()
+    )
+    try:
+        # Список пар Binance нужен при любом источнике цен, поэтому снимок берём до запуска потока
+        await load_binance_prices()
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Error loading Binance symbols: {e}")
+    application.bot_data["binance_stream"] = asyncio.create_task(binance_price_stream())
+    await start_webhook_server(application)
+    await reconcile_pending_invoices(application.bot)
+
+async def on_shutdown(application: Application):
+    await stop_webhook_server(application)
+    stream = application.bot_data.pop("binance_stream", None)
+    if stream:
+        stream.cancel()
+    if http_session:
+        await http_session.close()
+    await redis_pool.disconnect()
+
+async def start_webhook_server(application: Application):
+    web_app = web.Application()
+    web_app[APP_KEY] = application
+    web_app.router.add_post(CRYPTO_PAY_WEBHOOK_PATH, crypto_pay_webhook)
+    if TELEGRAM_WEBHOOK_URL:
+        web_app.router.add_post(TELEGRAM_WEBHOOK_PATH, telegram_webhook)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    application.bot_data["webhook_runner"] = runner
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+
+async def stop_webhook_server(application: Application):
+    runner = application.bot_data.pop("webhook_runner", None)
+    if runner:
+        await runner.cleanup()
+
+async def index_alert_users():
+    if await redis_client.exists('users_with_alerts'):
+        return
+    user_ids = [key.split(':', 1)[1] async for key in redis_client.scan_iter('alerts:*')]
+    if user_ids:
+        logger.info(f"Indexing {len(user_ids)} users with alerts...")
+        await redis_client.sadd('users_with_alerts', *user_ids)
+
+async def migrate_legacy_history():
+    # История раньше хранилась JSON-строкой; переводим такие ключи в списки
+    async for key in redis_client.scan_iter('history:*', _type='string'):
+        entries = orjson.loads(await redis_client.get(key) or '[]')[-HISTORY_LIMIT:]
+        ttl = await redis_client.ttl(key)
+        pipe = redis_client.pipeline()
+        pipe.delete(key)
+        if entries:
+            pipe.lpush(key, *(orjson.dumps(entry) for entry in entries))
+            pipe.expire(key, ttl if ttl > 0 else 30 * 24 * 60 * 60)
+        await pipe.execute()
+
+async def migrate_legacy_referrals():
+    # Рефералы раньше хранились JSON-списком; переводим такие ключи в множества
+    async for key in redis_client.scan_iter('referrals:*', _type='string'):
+        referrals = orjson.loads(await redis_client.get(key) or '[]')
+        ttl = await redis_client.ttl(key)
+        pipe = redis_client.pipeline()
+        pipe.delete(key)
+        if referrals:
+            pipe.sadd(key, *referrals)
+            pipe.expire(key, ttl if ttl > 0 else 30 * 24 * 60 * 60)
+        await pipe.execute()
+
+async def migrate_legacy_stats():
+    # Старый блоб читаем под WATCH и удаляем в той же транзакции, что пишет новые ключи:
+    # при сбое он остаётся на месте, а параллельный старт другого процесса лишь перезапустит транзакцию
+    await redis_client.transaction(migrate_legacy_stats_tx, 'stats')
+
+async def migrate_legacy_stats_tx(pipe):
+    raw = await pipe.get('stats')
+    if not raw:
+        return
+    stats = orjson.loads(raw)
+    users = stats.get("users", {})
+    logger.info(f"Migrating legacy stats for {len(users)} users...")
+    current_day = today()
+    pipe.multi()
+    for uid, data in users.items():
+        if data.get("last_reset") == current_day and data.get("requests"):
+            pipe.setex(daily_requests_key(uid), DAILY_REQUESTS_TTL, data["requests"])
+    if users:
+        pipe.sadd('stats:users', *users)
+    if stats.get("total_requests"):
+        pipe.incrby('stats:total', stats["total_requests"])
+    for request_type, count in stats.get("request_types", {}).items():
+        pipe.hincrby('stats:types', request_type, count)
+    subscriptions = [uid for uid, active in stats.get("subscriptions", {}).items() if active]
+    if subscriptions:
+        pipe.sadd('stats:subs', *subscriptions)
+    if stats.get("revenue"):
+        pipe.incrbyfloat('stats:revenue', stats["revenue"])
+    pipe.delete('stats')
 
 async def set_bot_commands(application: Application):
     try:
@@ -778,12 +1200,49 @@ async def set_bot_commands(application: Application):
     except TelegramError as e:
         logger.error(f"Failed to set bot commands: {e}")
 
+async def run_webhook(application: Application):
+    await on_startup(application)
+    await application.bot.set_webhook(
+        url=f"{TELEGRAM_WEBHOOK_URL.rstrip('/')}{TELEGRAM_WEBHOOK_PATH}",
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=True,
+        secret_token=TELEGRAM_WEBHOOK_SECRET
+    )
+    await application.start()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    try:
+        await stop_event.wait()
+    finally:
+        await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+
 def main():
+    if not asyncio.get_event_loop().run_until_complete(init_redis_connection()):
+        exit(1)
     try:
         logger.info("Initializing application...")
-        app = Application.builder().token(TELEGRAM_TOKEN).build()
+        app = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            # Запросы к Bot API мультиплексируются в HTTP/2; пул по умолчанию (1 соединение) мал для рассылки алертов
+            .request(HTTPXRequest(
+                http_version="2",
+                connection_pool_size=TELEGRAM_POOL_SIZE,
+                pool_timeout=10,
+                connect_timeout=10,
+                read_timeout=20
+            ))
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
+            .build()
+        )
 
         logger.info("Adding handlers...")
+        app.add_handler(TypeHandler(Update, subscription_gate), group=-1)
         app.add_handler(CommandHandler("start", start))
         app.add_handler(CommandHandler("currencies", currencies))
         app.add_handler(CommandHandler("alert", alert))
@@ -799,8 +1258,11 @@ def main():
             return
 
         logger.info("Scheduling jobs...")
-        app.job_queue.run_repeating(check_payment_job, interval=60, name="check_payment")
-        app.job_queue.run_repeating(check_alerts_job, interval=60, name="check_alerts")
+        app.job_queue.run_repeating(refresh_binance_prices, interval=BINANCE_SNAPSHOT_INTERVAL, first=0, name="refresh_binance_prices")
+        # Сверка неоплаченных счетов на случай потерянных вебхуков Crypto Pay
+        app.job_queue.run_repeating(reconcile_invoices_job, interval=INVOICE_RECONCILE_INTERVAL, first=INVOICE_RECONCILE_INTERVAL, name="reconcile_invoices")
+        # Проверка алертов сдвинута от старта и слегка размыта, чтобы не совпадать по фазе с другими задачами
+        app.job_queue.run_repeating(check_alerts_job, interval=60, first=30, name="check_alerts", job_kwargs={"jitter": 5})
 
         logger.info("Initializing bot...")
         asyncio.get_event_loop().run_until_complete(app.initialize())
@@ -808,15 +1270,26 @@ def main():
         logger.info("Setting bot commands...")
         asyncio.get_event_loop().run_until_complete(set_bot_commands(app))
 
-        if not redis_client.exists('stats'):
-            logger.info("Initializing stats in Redis...")
-            redis_client.setex('stats', 30 * 24 * 60 * 60, json.dumps({"users": {}, "total_requests": 0, "request_types": {}, "subscriptions": {}, "revenue": 0.0}))
+        asyncio.get_event_loop().run_until_complete(migrate_legacy_stats())
+        asyncio.get_event_loop().run_until_complete(migrate_legacy_history())
+        asyncio.get_event_loop().run_until_complete(migrate_legacy_referrals())
+        asyncio.get_event_loop().run_until_complete(index_alert_users())
 
-        logger.info("Bot starting polling...")
-        app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True, timeout=30)
+        if TELEGRAM_WEBHOOK_URL:
+            logger.info("Bot starting webhook...")
+            asyncio.get_event_loop().run_until_complete(run_webhook(app))
+        else:
+            logger.info("Bot starting polling...")
+            app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True, timeout=30)
     except Exception as e:
         logger.critical(f"Fatal error in main: {e}")
         raise
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("Using uvloop event loop")
+    except ImportError:
+        logger.info("uvloop not available, using default asyncio event loop")
     main()